@@ -19,13 +19,38 @@
 
 '''Configuration Module'''
 
-from archversion import XDG_DIRECTORY
-from archversion.error import MissingConfigFile
+from archversion import XDG_DIRECTORY, VERSION
+from archversion.error import MissingConfigFile, InvalidConfigFile
+from archversion.network import NetworkPolicy
 from collections import OrderedDict
 from configparser import RawConfigParser
-from logging import debug
+from logging import debug, error
 from os.path import join, exists
-from xdg.BaseDirectory import save_config_path
+from xdg.BaseDirectory import save_cache_path, save_config_path
+import hashlib
+import json
+import os
+import re
+
+# Default upstream regex parts
+REGEX_VERSION = r"[-.\w]+"
+REGEX_EXT = r"\.(?:tar(?:\.gz|\.bz2|\.xz)?|tgz|tbz2|zip)"
+
+# Default upstream exclusion regex
+REGEX_EXCLUDE = ".*(rc|beta|alpha|pre).*"
+
+# Duration units in seconds
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def duration(value):
+    '''
+    Return the number of seconds of a duration
+    Duration is a number optionally followed by a unit (s, m, h or d)
+    '''
+    value = value.strip()
+    if value[-1:] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
 
 class BaseConfigFile(OrderedDict):
     '''Base config file class'''
@@ -47,3 +72,153 @@ class BaseConfigFile(OrderedDict):
         self._configparser.read(self.path)
         for name in self._configparser.sections():
             self[name] = OrderedDict(self._configparser.items(name))
+
+class CompiledPackages(dict):
+    '''Compiled packages configuration, compiled on first access'''
+
+    def __init__(self, config):
+        dict.__init__(self)
+        self._config = config
+
+    def __missing__(self, name):
+        compiled = self[name] = PackagesConfigFile.compile(name, self._config[name])
+        return compiled
+
+class PackagesConfigFile(BaseConfigFile):
+    '''
+    Packages config file class
+    Parsed sections are kept in a snapshot in cache, which is used while
+    the config file is unchanged. aliases holds aliases of packages and
+    index the package name of each package and alias name.
+    '''
+
+    def load(self):
+        '''
+        Load configuration and compile regex and eval expressions of
+        all packages. Invalid packages are all reported before raising
+        InvalidConfigFile.
+        Configuration loaded from the snapshot was already checked, so
+        packages are compiled when they are used.
+        '''
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, "rb") as fileobj:
+            digest = hashlib.sha1(fileobj.read()).hexdigest()
+        snapshot_path = join(save_cache_path(XDG_DIRECTORY),
+                             "%s.snapshot" % os.path.basename(self.path))
+        key = {"version": VERSION, "mtime": mtime, "hash": digest}
+        self.aliases = OrderedDict()
+        self.compiled = CompiledPackages(self)
+        snapshot = self.read_snapshot(snapshot_path, key)
+        if snapshot is not None:
+            for name, value, aliases in snapshot:
+                self[name] = OrderedDict(value)
+                self.aliases[name] = aliases
+        else:
+            BaseConfigFile.load(self)
+            invalid = False
+            for name, value in self.items():
+                self.aliases[name] = [ alias for alias in
+                                       value.get("alias", "").split(" ")
+                                       if alias != "" ]
+                try:
+                    self.compiled[name] = self.compile(name, value)
+                except InvalidConfigFile:
+                    invalid = True
+            if invalid:
+                raise InvalidConfigFile()
+            self.write_snapshot(snapshot_path, key)
+        # package name of packages and aliases
+        self.index = {}
+        for name, aliases in reversed(self.aliases.items()):
+            for alias in aliases:
+                self.index[alias] = name
+        for name in self.aliases:
+            self.index[name] = name
+
+    def read_snapshot(self, path, key):
+        '''Return snapshot sections if the snapshot matches key'''
+        try:
+            with open(path, "r") as fileobj:
+                snapshot = json.load(fileobj)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("key") != key:
+            debug("Config snapshot is outdated")
+            return None
+        debug("Loading config snapshot %s" % path)
+        return snapshot["sections"]
+
+    def write_snapshot(self, path, key):
+        '''Write a snapshot of sections'''
+        debug("Saving config snapshot %s" % path)
+        snapshot = {"key": key,
+                    "sections": [ (name, value, self.aliases[name])
+                                  for name, value in self.items() ]}
+        try:
+            tmppath = "%s.tmp" % path
+            with open(tmppath, "w") as fileobj:
+                json.dump(snapshot, fileobj)
+            os.replace(tmppath, path)
+        except OSError as exp:
+            error("Unable to save config snapshot %s: %s" % (path, exp))
+
+    @staticmethod
+    def compile(name, value):
+        '''
+        Return a dict of compiled regex, eval expressions and check
+        intervals of a package
+        '''
+        compiled = {"regex_exclude": None}
+        sources = {}
+        sources["regex"] = value.get("regex", "%s[-_]v?(%s)%s" % (
+            value.get("regex_name", name),
+            value.get("regex_version", REGEX_VERSION),
+            value.get("regex_ext", REGEX_EXT)))
+        if value.get("regex_exclude", REGEX_EXCLUDE) != "":
+            sources["regex_exclude"] = value.get("regex_exclude", REGEX_EXCLUDE)
+        for key in ("eval_upstream", "eval_downstream"):
+            if key in value:
+                sources[key] = value[key]
+        sources["check_interval"] = value.get("check_interval", "0")
+        sources["check_interval_max"] = value.get("check_interval_max", "7d")
+        sources["check_backoff"] = value.get("check_backoff", "0")
+        invalid = False
+        try:
+            compiled["policy"] = PackagesConfigFile.policy(value)
+        except ValueError as exp:
+            error("%s: invalid network policy: %s" % (name, exp))
+            invalid = True
+        for key, source in sources.items():
+            try:
+                if key.startswith("regex"):
+                    compiled[key] = re.compile(source)
+                elif key.startswith("eval"):
+                    compiled[key] = compile(source, "%s:%s" % (name, key), "eval")
+                elif key == "check_backoff":
+                    compiled[key] = float(source)
+                else:
+                    compiled[key] = duration(source)
+            except (re.error, SyntaxError, ValueError) as exp:
+                error("%s: invalid %s: %s" % (name, key, exp))
+                invalid = True
+        if invalid:
+            raise InvalidConfigFile()
+        return compiled
+
+    @staticmethod
+    def policy(value):
+        '''
+        Return the network policy of a package
+        A burst under one request would never allow a request.
+        '''
+        policy = NetworkPolicy(int(value.get("retry", 0)),
+                               duration(value.get("retry_delay", "1")),
+                               duration(value.get("retry_delay_max", "60")),
+                               float(value.get("host_rate", 0)),
+                               int(value.get("host_burst", 1)))
+        for option in ("retry", "retry_delay", "retry_delay_max"):
+            if getattr(policy, option) < 0:
+                raise ValueError("%s must not be negative" % option)
+        if policy.host_burst < 1:
+            raise ValueError("host_burst must be at least 1")
+        return policy
@@ -0,0 +1,232 @@
+# coding: utf-8
+
+# archversion - Archlinux Version Controller
+# Copyright © 2012 Sébastien Luttringer
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+'''Daemon Module'''
+
+from archversion import XDG_DIRECTORY, CONFIG_PACKAGES, DAEMON_SOCKET
+from archversion import CACHE_PACKAGES, CACHE_PACKAGES_SQLITE
+from archversion.error import BaseError
+from archversion.pacman import Pacman
+from archversion.version import VersionController
+from os.path import join
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from threading import Event, Lock, Thread
+from time import time
+from xdg.BaseDirectory import save_cache_path, save_config_path
+import logging
+import os
+import signal
+import socket
+import sys
+
+def socket_path():
+    '''Return the default path of the daemon query socket'''
+    rundir = os.environ.get("XDG_RUNTIME_DIR", None)
+    if rundir is None:
+        rundir = save_cache_path(XDG_DIRECTORY)
+    return join(rundir, DAEMON_SOCKET)
+
+class QueryServer(ThreadingMixIn, UnixStreamServer):
+    '''Unix socket server answering queries in threads'''
+    daemon_threads = True
+
+class QueryHandler(StreamRequestHandler):
+    '''
+    Answer a query
+    A query is a line of words: a command followed by its options and
+    package names. The reply is a line by result and ends with the
+    connection.
+    '''
+
+    def handle(self):
+        words = self.rfile.readline(65536).decode("utf-8", "replace").split()
+        # connections closed without query, like the listening probe
+        if len(words) == 0:
+            return
+        try:
+            lines = self.server.archversion.query(words)
+        except Exception as exp:
+            lines = ["error\t%s" % exp]
+        try:
+            self.wfile.write("".join("%s\n" % line for line in lines).encode())
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug("Query client went away before the reply")
+
+class Daemon(object):
+    '''
+    Resident version controller
+    Packages are synced every interval seconds. Queries are answered from
+    versions of the last sync, and config and cache are loaded again when
+    they change on disk.
+    '''
+
+    def __init__(self, cache="json", interval=14400, jobs=1, host_jobs=2,
+                 poll=5):
+        self.interval = interval
+        self.jobs = jobs
+        self.host_jobs = host_jobs
+        self.poll = poll
+        self._vctrl = VersionController(cache)
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._sync_asked = False
+        self._reload_asked = False
+        self._versions = []
+        self._synced = None
+        self._stamps = None
+        # watched files
+        cachepath = join(save_cache_path(XDG_DIRECTORY),
+            CACHE_PACKAGES_SQLITE if cache == "sqlite" else CACHE_PACKAGES)
+        self._paths = [join(save_config_path(XDG_DIRECTORY), CONFIG_PACKAGES),
+                       cachepath]
+        if cache == "sqlite":
+            self._paths.append("%s-wal" % cachepath)
+
+    def stamps(self):
+        '''Return modification times of watched files'''
+        stamps = []
+        for path in self._paths:
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def refresh(self):
+        '''
+        Compute answered versions from the loaded cache
+        Must be called with the lock held
+        '''
+        self._versions = list(self._vctrl.compare(record=False))
+        self._stamps = self.stamps()
+
+    def reload(self):
+        '''Load config and cache again'''
+        with self._lock:
+            logging.debug("Reloading config and cache")
+            self._vctrl.reload()
+            self.refresh()
+
+    def sync(self):
+        '''Sync packages and save the cache'''
+        with self._lock:
+            logging.debug("Syncing packages")
+            # see pacman databases updates
+            Pacman.reset()
+            self._vctrl.sync(self.jobs, self.host_jobs)
+            self._vctrl.save()
+            self._synced = time()
+            self.refresh()
+
+    def query(self, words):
+        '''
+        Return answer lines of a query
+        Commands are:
+          report [-n|--new] [package...]: tab separated versions
+          check [-n|--new] [package...]: sync, then report
+          sync: ask for a sync in background
+          reload: load config and cache again
+          status: time of last sync and count of versions
+        '''
+        if len(words) == 0:
+            raise BaseError("Empty query")
+        command, args = words[0], words[1:]
+        if command in ("report", "check"):
+            if command == "check":
+                self.sync()
+            only_new = "-n" in args or "--new" in args
+            names = set(arg for arg in args if not arg.startswith("-"))
+            return [ "%s\t%s\t%s" % (name, v_upstream, v_downstream)
+                     for name, v_upstream, v_downstream in self._versions
+                     if (not only_new or v_upstream != v_downstream)
+                     and (len(names) == 0 or name in names) ]
+        if command == "sync":
+            self._sync_asked = True
+            self._wakeup.set()
+            return []
+        if command == "reload":
+            self.reload()
+            return []
+        if command == "status":
+            return ["synced\t%s" % (int(self._synced) if self._synced else ""),
+                    "versions\t%d" % len(self._versions)]
+        raise BaseError("Unknown query command: %s" % command)
+
+    def run(self, path=None):
+        '''
+        Serve queries on unix socket path and sync periodically until
+        killed. SIGHUP loads config and cache again.
+        '''
+        if path is None:
+            path = socket_path()
+        if os.path.exists(path):
+            if self.listening(path):
+                raise BaseError("A daemon is already listening on %s" % path)
+            # socket left by a killed daemon
+            os.unlink(path)
+        server = QueryServer(path, QueryHandler)
+        server.archversion = self
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.ask_reload())
+        try:
+            with self._lock:
+                self.refresh()
+            Thread(target=server.serve_forever, daemon=True).start()
+            logging.debug("Listening queries on %s" % path)
+            next_sync = time()
+            while True:
+                if self._reload_asked or self.stamps() != self._stamps:
+                    self._reload_asked = False
+                    try:
+                        self.reload()
+                    except Exception as exp:
+                        logging.error("Reload failed: %s" % exp)
+                        self._stamps = self.stamps()
+                if self._sync_asked or time() >= next_sync:
+                    self._sync_asked = False
+                    try:
+                        self.sync()
+                    except Exception as exp:
+                        logging.error("Sync failed: %s" % exp)
+                    next_sync = time() + self.interval
+                self._wakeup.wait(min(self.poll, max(next_sync - time(), 0)))
+                self._wakeup.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(path)
+
+    @staticmethod
+    def listening(path):
+        '''Return True if a process accepts connections on unix socket path'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def ask_reload(self):
+        '''Ask the main loop to load config and cache again'''
+        self._reload_asked = True
+        self._wakeup.set()
+
+# vim:set ts=4 sw=4 et ai:
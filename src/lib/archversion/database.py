@@ -21,17 +21,63 @@
 
 from archversion import XDG_DIRECTORY
 from archversion.error import BaseError
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from os.path import join
+from threading import Lock
 from xdg.BaseDirectory import save_cache_path
 import json
 import logging
+import os
+
+
+class JsonTable(dict):
+    '''
+    Table of a json database
+    The database is marked as changed when the table is updated.
+    '''
+
+    def __init__(self, database, *args):
+        dict.__init__(self, *args)
+        self._db = database
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._db.dirty = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._db.dirty = True
+
+    def pop(self, *args):
+        self._db.dirty = True
+        return dict.pop(self, *args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._db.dirty = True
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._db.dirty = True
+
+    def clear(self):
+        dict.clear(self)
+        self._db.dirty = True
 
 
 class JsonDatabase(dict):
-    '''Json database'''
+    '''
+    Json database
+    Values are tables, which are only saved when updated since loading.
+    '''
 
     _path = None
 
+    # database was updated since loaded or saved
+    dirty = False
+
     def __del__(self):
         if self._path is not None:
             self.save()
@@ -48,22 +94,181 @@ class JsonDatabase(dict):
         try:
             fileobj = open(path, "r")
             dico = json.load(fileobj)
-            self.update(dico)
+            for key, value in dico.items():
+                self[key] = value
         except Exception as exp:
             logging.error("Unable to load database %s: %s" % (path, exp))
+        self.dirty = False
         # because we use self._path is __del__, this should be done when
         # we are sure that db is loaded
         self._path = path
 
+    def close(self):
+        '''Forget the database file, changes are no more saved'''
+        self._path = None
+
+    @contextmanager
+    def batch(self):
+        '''Nothing to do, entries are saved at once by save'''
+        yield
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            value = JsonTable(self, value)
+        dict.__setitem__(self, key, value)
+        self.dirty = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.dirty = True
+
+    def clear(self):
+        dict.clear(self)
+        self.dirty = True
+
     def save(self, save_empty=False):
-        '''Save current version database into a file'''
+        '''Save current version database into a file, if it changed'''
         if not save_empty and len(self) == 0:
             logging.debug("Not saved. Database is empty")
             return
+        if not self.dirty:
+            logging.debug("Not saved. Database is unchanged")
+            return
         if self._path is not None:
             logging.debug("Saving database %s" % self._path)
             try:
-                fileobj = open(self._path, "w")
-                json.dump(self, fileobj)
+                # write a new file and replace the old one atomically
+                tmppath = "%s.tmp" % self._path
+                with open(tmppath, "w") as fileobj:
+                    json.dump(self, fileobj)
+                os.replace(tmppath, self._path)
+                self.dirty = False
             except Exception as exp:
                 logging.error("Unable to save database %s: %s" % (self._path, exp))
+
+
+class SqliteDatabase(object):
+    '''
+    Sqlite database
+    Provide the JsonDatabase interface with a fixed set of tables. Each
+    entry is loaded when accessed and written as soon as it is updated.
+    '''
+
+    tables = ("upstream", "downstream", "compare", "status", "fresh")
+
+    _conn = None
+
+    def load(self, filename):
+        '''Open registered version database'''
+        # sqlite3 is only loaded with this backend
+        import sqlite3
+        assert(filename is not None)
+        path = join(save_cache_path(XDG_DIRECTORY), filename)
+        logging.debug("Loading database %s" % path)
+        try:
+            self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            # allow readers while a sync is writing
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "tbl TEXT, name TEXT, value TEXT, "
+                               "PRIMARY KEY (tbl, name))")
+        except sqlite3.Error as exp:
+            raise BaseError("Unable to load database %s: %s" % (path, exp))
+        self._lock = Lock()
+
+    def save(self):
+        '''Nothing to do, entries are saved when they are updated'''
+        pass
+
+    @contextmanager
+    def batch(self):
+        '''
+        Write entries updated in the block in one transaction
+        Entries must not be updated by other threads meanwhile.
+        '''
+        self.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.execute("ROLLBACK")
+            raise
+        self.execute("COMMIT")
+
+    def close(self):
+        '''Close the database connection'''
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def keys(self):
+        return self.tables
+
+    def clear(self):
+        self.execute("DELETE FROM entries")
+
+    def __getitem__(self, table):
+        if table not in self.tables:
+            raise KeyError(table)
+        return SqliteTable(self, table)
+
+    def __setitem__(self, table, entries):
+        if table not in self.tables:
+            raise KeyError(table)
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute("DELETE FROM entries WHERE tbl=?", (table,))
+                self._conn.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                    ((table, k, json.dumps(v)) for k, v in entries.items()))
+
+    def execute(self, query, args=()):
+        '''Return all rows of query'''
+        with self._lock:
+            return self._conn.execute(query, args).fetchall()
+
+
+class SqliteTable(MutableMapping):
+    '''Entries of a sqlite database table'''
+
+    def __init__(self, database, table):
+        self._db = database
+        self._table = table
+
+    def __getitem__(self, name):
+        rows = self._db.execute("SELECT value FROM entries WHERE tbl=? AND name=?",
+                                (self._table, name))
+        if len(rows) == 0:
+            raise KeyError(name)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, name, value):
+        self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                         (self._table, name, json.dumps(value)))
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._db.execute("DELETE FROM entries WHERE tbl=? AND name=?",
+                         (self._table, name))
+
+    def __contains__(self, name):
+        return len(self._db.execute("SELECT 1 FROM entries WHERE tbl=? AND name=?",
+                                    (self._table, name))) > 0
+
+    def __iter__(self):
+        rows = self._db.execute("SELECT name FROM entries WHERE tbl=?",
+                                (self._table,))
+        return iter([ row[0] for row in rows ])
+
+    def items(self):
+        '''Return all entries of the table, read in one query'''
+        rows = self._db.execute("SELECT name, value FROM entries WHERE tbl=?",
+                                (self._table,))
+        return [ (name, json.loads(value)) for name, value in rows ]
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries WHERE tbl=?",
+                                (self._table,))[0][0]
@@ -33,6 +33,14 @@ class VersionNotFound(BaseError):
     '''Version of a package is not found'''
     pass
 
+class NotModified(BaseError):
+    '''Upstream page didn't change since last check'''
+    pass
+
+class UnsupportedSyntax(BaseError):
+    '''PKGBUILD cannot be parsed without a shell'''
+    pass
+
 class NoSuchFile(BaseError):
     '''Config file is bad formatted'''
 
@@ -0,0 +1,574 @@
+# coding: utf-8
+
+# archversion - Archlinux Version Controller
+# Copyright © 2012 Sébastien Luttringer
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+'''Network Module'''
+
+from archversion import HTTP_HEADERS
+from archversion.stats import record
+from collections import namedtuple
+from threading import Lock, Semaphore
+from time import monotonic, sleep, time
+from urllib.parse import urljoin, urlsplit
+import logging
+import random
+import zlib
+
+# http.client, urllib.request and urllib.error are slow to import, they are
+# imported by functions doing requests, so commands without requests don't
+# pay them.
+
+# Content of an http response
+Response = namedtuple("Response", ("status", "headers", "data"))
+
+# Maximum number of followed redirections
+MAX_REDIRECTS = 10
+
+# Size of read chunks of streamed responses
+CHUNK_SIZE = 65536
+
+# Url schemes requested on keep-alive connections, others use urllib
+POOLED_SCHEMES = ("http", "https")
+
+# Http status worth to retry
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+class NetworkPolicy(namedtuple("NetworkPolicy", ("retry", "retry_delay",
+        "retry_delay_max", "host_rate", "host_burst"))):
+    '''
+    Politeness of requests
+    Failed requests are retried retry times, after an exponential and
+    jittered delay. Requests on a host are limited to host_rate per second
+    with bursts of host_burst requests (no limit when host_rate is 0).
+    '''
+
+    def __new__(cls, retry=0, retry_delay=1.0, retry_delay_max=60.0,
+                host_rate=0.0, host_burst=1):
+        return super().__new__(cls, retry, retry_delay, retry_delay_max,
+                               host_rate, host_burst)
+
+    def delay(self, ntry, retry_after=None):
+        '''
+        Return the delay before the try number ntry (starting at 2)
+        retry_after is the delay asked by the server
+        '''
+        if retry_after is not None:
+            return min(retry_after, self.retry_delay_max)
+        delay = min(self.retry_delay * 2 ** (ntry - 2), self.retry_delay_max)
+        return delay * random.uniform(0.5, 1)
+
+class TokenBucket(object):
+    '''
+    Limit the rate of events
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        '''
+        Wait until an event is allowed
+        '''
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+class HttpClient(object):
+    '''
+    Cheap HTTP client shared by upstream and downstream fetchers
+    This object is a singleton to share per host limits and keep-alive
+    connections between threads
+    '''
+
+    _instance = None
+    _lock = Lock()
+
+    # maximum number of concurrent requests on the same host
+    host_jobs = 2
+
+    def __new__(cls):
+        # singleton design pattern
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = object.__new__(cls)
+                cls._hosts = {}
+                cls._buckets = {}
+                cls._pool = {}
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        '''
+        Forget host limits and kept alive connections
+        Must be called by forked processes, so they don't share the
+        connections of their parent
+        '''
+        with cls._lock:
+            cls._instance = None
+
+    def throttle(self, url, policy):
+        '''
+        Wait until a request on url host is allowed by policy
+        '''
+        if policy.host_rate <= 0:
+            return
+        netloc = urlsplit(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(netloc)
+            if bucket is None:
+                bucket = self._buckets[netloc] = TokenBucket(policy.host_rate,
+                                                             policy.host_burst)
+            # last policy wins
+            bucket.rate = policy.host_rate
+            bucket.burst = policy.host_burst
+        bucket.acquire()
+
+    def host(self, url):
+        '''
+        Return the semaphore which limits concurrent requests on url host
+        '''
+        netloc = urlsplit(url).netloc
+        with self._lock:
+            if netloc not in self._hosts:
+                self._hosts[netloc] = Semaphore(self.host_jobs)
+            return self._hosts[netloc]
+
+    def get(self, url, timeout=None, headers=None, policy=None):
+        '''
+        Return the response of url
+        headers are sent in addition of archversion ones
+        Not modified responses (304) are returned with empty data
+        Requests are throttled and retried, until the content is read,
+        according to policy
+        Raise HTTPError on error status
+        '''
+        if policy is None:
+            policy = NetworkPolicy()
+        req_headers = self.request_headers(headers)
+        def fetch():
+            with self._open(url, timeout, req_headers, policy) as stream:
+                return Response(stream.status, stream.headers, stream.read())
+        return self.retry(url, policy, fetch)
+
+    def open(self, url, timeout=None, headers=None, policy=None):
+        '''
+        Return an HttpStream on the response of url
+        The stream must be closed to release its connection
+        Requests are throttled and retried according to policy, until the
+        response headers are received. Use retry to also retry failures
+        while reading the content.
+        Raise HTTPError on error status
+        '''
+        if policy is None:
+            policy = NetworkPolicy()
+        req_headers = self.request_headers(headers)
+        return self.retry(url, policy,
+                          lambda: self._open(url, timeout, req_headers, policy))
+
+    @staticmethod
+    def request_headers(headers):
+        '''
+        Return headers of a request with headers in addition of archversion ones
+        '''
+        req_headers = dict(HTTP_HEADERS)
+        req_headers["Accept-Encoding"] = "gzip, deflate"
+        if headers is not None:
+            req_headers.update(headers)
+        return req_headers
+
+    def retry(self, url, policy, func):
+        '''
+        Return the result of func, a request of url, called again after a
+        transient failure according to policy
+        '''
+        from http.client import HTTPException
+        ntry = policy.retry + 1
+        for n in range(1, ntry + 1):
+            try:
+                return func()
+            except (HTTPException, OSError) as exp:
+                if n == ntry or not self.transient(exp):
+                    raise
+                delay = policy.delay(n + 1, self.retry_after(exp))
+                logging.debug("Request of %s failed: %s. Retrying in %.1fs "
+                              "(try %d/%d)" % (url, exp, delay, n + 1, ntry))
+                sleep(delay)
+
+    @staticmethod
+    def transient(exp):
+        '''
+        Return True if a request failure is worth to retry
+        '''
+        from urllib.error import HTTPError
+        if isinstance(exp, HTTPError):
+            return exp.code in RETRY_STATUS
+        return True
+
+    @staticmethod
+    def retry_after(exp):
+        '''
+        Return the delay in seconds asked by a server before retrying
+        '''
+        from email.utils import parsedate_to_datetime
+        from urllib.error import HTTPError
+        if not isinstance(exp, HTTPError) or exp.headers is None:
+            return None
+        value = exp.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def _open(self, url, timeout, req_headers, policy):
+        '''
+        Return an HttpStream on the response of url following redirections
+        '''
+        from urllib.error import HTTPError
+        for _ in range(MAX_REDIRECTS + 1):
+            logging.debug("Requesting url: %s" % url)
+            logging.debug("Timeout is %s" % timeout)
+            self.throttle(url, policy)
+            stream = HttpStream(self, url, timeout, req_headers)
+            if stream.status in (301, 302, 303, 307, 308) and \
+               "Location" in stream.headers:
+                # the host slot is released even if the body read fails
+                with stream:
+                    stream.read()
+                url = urljoin(url, stream.headers["Location"])
+                logging.debug("Redirected to: %s" % url)
+                continue
+            if stream.status == 304:
+                logging.debug("Not modified: %s" % url)
+            elif stream.status >= 400:
+                stream.close()
+                raise HTTPError(url, stream.status, stream.reason,
+                                stream.headers, None)
+            return stream
+        raise HTTPError(url, stream.status, "Too many redirections",
+                        stream.headers, None)
+
+    @staticmethod
+    def proxied(url):
+        '''
+        Return True if url should be requested through a proxy
+        '''
+        from urllib.request import getproxies, proxy_bypass
+        scheme, netloc = urlsplit(url)[:2]
+        return scheme in getproxies() and not proxy_bypass(netloc)
+
+    def _connection(self, key, timeout):
+        '''
+        Return a tuple of a connection to key host and if it is reused
+        '''
+        with self._lock:
+            idle = self._pool.get(key, [])
+            conn = idle.pop() if len(idle) > 0 else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+        from http.client import HTTPConnection, HTTPSConnection
+        scheme, netloc = key
+        if scheme == "https":
+            return (HTTPSConnection(netloc, timeout=timeout), False)
+        if scheme == "http":
+            return (HTTPConnection(netloc, timeout=timeout), False)
+        raise ValueError("Unsupported url scheme: %s" % scheme)
+
+    def _release(self, key, conn):
+        '''
+        Keep alive a connection to key host for next requests
+        '''
+        with self._lock:
+            idle = self._pool.setdefault(key, [])
+            if len(idle) < self.host_jobs:
+                idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def decoder(headers):
+        '''
+        Return a decompress object for the content encoding of headers
+        or None when the content is not encoded
+        '''
+        encoding = headers.get("Content-Encoding", "identity").lower()
+        if encoding == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if encoding == "deflate":
+            return zlib.decompressobj()
+        return None
+
+    @staticmethod
+    def validators(response):
+        '''
+        Return a dict of the cache validators of a response
+        '''
+        validators = {}
+        if response.headers.get("ETag") is not None:
+            validators["etag"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified") is not None:
+            validators["modified"] = response.headers["Last-Modified"]
+        return validators
+
+    @staticmethod
+    def conditional_headers(validators):
+        '''
+        Return request headers to only get a resource modified since
+        validators were received
+        '''
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "modified" in validators:
+            headers["If-Modified-Since"] = validators["modified"]
+        return headers
+
+class HttpStream(object):
+    '''
+    Streamed http response
+    Iterating over a stream yields chunks of content decoded from its
+    content encoding. A slot of the url host is held until the stream
+    is closed. Connection is kept alive when the content was fully read
+    or when the response has no content.
+    '''
+
+    def __init__(self, client, url, timeout, headers):
+        self._client = client
+        self._netloc = urlsplit(url).netloc
+        self._host = client.host(url)
+        self._host.acquire()
+        self._conn = self._key = None
+        self._complete = False
+        # time spent and raw bytes read while downloading the content
+        self.elapsed = 0.0
+        self.size = 0
+        start = monotonic()
+        try:
+            if client.proxied(url) or \
+               urlsplit(url).scheme not in POOLED_SCHEMES:
+                self._urlopen(url, timeout, headers)
+            else:
+                self._request(url, timeout, headers)
+        except BaseException:
+            self._host.release()
+            raise
+        finally:
+            record("connect", monotonic() - start, self._netloc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        decoder = HttpClient.decoder(self.headers)
+        first = True
+        while True:
+            start = monotonic()
+            chunk = self._resp.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                # partial reads don't report a connection closed too early
+                if getattr(self._resp, "length", None):
+                    from http.client import IncompleteRead
+                    raise IncompleteRead(b"", self._resp.length)
+                break
+            self.size += len(chunk)
+            if decoder is not None:
+                try:
+                    chunk = decoder.decompress(chunk)
+                except zlib.error:
+                    # some servers send raw deflate streams without zlib header
+                    if not first:
+                        raise
+                    decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                    chunk = decoder.decompress(chunk)
+            first = False
+            self.elapsed += monotonic() - start
+            yield chunk
+        self._complete = True
+        if decoder is not None:
+            yield decoder.flush()
+
+    def read(self):
+        '''
+        Return the whole decoded content
+        '''
+        return b"".join(self)
+
+    def close(self):
+        '''
+        Release the connection and the host slot
+        '''
+        if self._host is None:
+            return
+        if self._conn is None:
+            self._resp.close()
+        elif self._complete and not self._resp.will_close:
+            self._client._release(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._host.release()
+        self._host = None
+        record("download", self.elapsed, self._netloc, size=self.size)
+
+    def _urlopen(self, url, timeout, headers):
+        '''
+        Request url with urllib
+        Used when a proxy is configured and connections cannot be reused,
+        and for non http urls (ftp, file)
+        '''
+        from urllib.error import HTTPError
+        from urllib.request import urlopen, Request
+        try:
+            self._resp = urlopen(Request(url, headers=headers), timeout=timeout)
+        except HTTPError as exp:
+            if exp.code != 304:
+                raise
+            self._resp = exp
+        # ftp and file responses have no status
+        self.status = self._resp.status or 200
+        self.reason = getattr(self._resp, "reason", "")
+        self.headers = self._resp.headers
+
+    def _request(self, url, timeout, headers):
+        '''
+        Request url on a keep-alive connection
+        '''
+        from http.client import HTTPException
+        scheme, netloc, path, query = urlsplit(url)[:4]
+        if query != "":
+            path = "%s?%s" % (path, query)
+        self._key = (scheme, netloc)
+        while True:
+            self._conn, reused = self._client._connection(self._key, timeout)
+            try:
+                self._conn.request("GET", path or "/", headers=headers)
+                self._resp = self._conn.getresponse()
+                break
+            except (HTTPException, OSError):
+                self._conn.close()
+                # kept alive connection was closed by the server
+                if reused:
+                    logging.debug("Reconnecting to %s" % netloc)
+                    continue
+                raise
+        self.status = self._resp.status
+        self.reason = self._resp.reason
+        self.headers = self._resp.msg
+        # responses without content (304, 204, empty) are complete, reading
+        # them makes the connection ready for the next request
+        if self._resp.length == 0:
+            self._resp.read()
+            self._complete = True
+
+class BufferedStream(object):
+    '''
+    Stream interface over a fully read response
+    '''
+
+    def __init__(self, response):
+        self.status = response.status
+        self.headers = response.headers
+        self._data = response.data
+        self.elapsed = 0.0
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        yield self._data
+
+    def read(self):
+        '''Return the whole content'''
+        return self._data
+
+    def close(self):
+        '''Nothing to release'''
+        pass
+
+class UrlCache(object):
+    '''
+    Share responses of urls requested by several packages
+    Each distinct url and headers is fetched once. Only urls given at
+    creation are cached, others are directly requested.
+    '''
+
+    def __init__(self, urls=()):
+        self._urls = set(urls)
+        self._lock = Lock()
+        self._entries = {}
+        self.fetched = 0
+        self.saved = 0
+
+    def get(self, url, timeout=None, headers=None, policy=None):
+        '''
+        Return the response of url
+        Failed requests are not cached
+        '''
+        if url not in self._urls:
+            return HttpClient().get(url, timeout, headers, policy)
+        key = (url, tuple(sorted((headers or {}).items())))
+        with self._lock:
+            entry = self._entries.setdefault(key, {"lock": Lock()})
+        # concurrent requests of the same url wait the first one
+        with entry["lock"]:
+            if "response" in entry:
+                logging.debug("Reusing response of url: %s" % url)
+                counter = "saved"
+            else:
+                entry["response"] = HttpClient().get(url, timeout, headers, policy)
+                counter = "fetched"
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        return entry["response"]
+
+    def open(self, url, timeout=None, headers=None, policy=None):
+        '''
+        Return a stream on the response of url
+        Shared urls are fully read and buffered
+        '''
+        if url not in self._urls:
+            return HttpClient().open(url, timeout, headers, policy)
+        return BufferedStream(self.get(url, timeout, headers, policy))
+
+# vim:set ts=4 sw=4 et ai:
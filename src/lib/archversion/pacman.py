@@ -20,13 +20,63 @@
 '''PKGBUILD Module'''
 
 
+from archversion.error import UnsupportedSyntax
+from archversion.stats import count
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from threading import Lock
 import logging
 import os
-import pycman
 import re
 import subprocess
 
+# Pacman version format: [epoch:]pkgver[-pkgrel]
+PACMAN_VERSION = re.compile(r"^(?:(\d+)\:)?([^-:]*)(?:-(\d+))?")
+
+# Count of PKGBUILD parsed by parser (native or shell), see count_parser
+PARSERS = Counter()
+PARSERS_LOCK = Lock()
+
+# PKGBUILD assignments changed by a version update
+PKGBUILD_VERSION = re.compile(r"^([ \t\r\f\v]*(_?pkgver|pkgrel)=).*$", re.MULTILINE)
+
 def parse_pkgbuild(path, shell="bash"):
+    '''
+    Source variable from a PKGBUILD
+    PKGBUILD is statically parsed when possible, otherwise it is sourced
+    by shell. Used parsers are counted in PARSERS.
+
+    WARNING: CODE MAY BE EXECUTED
+    '''
+    try:
+        pkgdict = PkgbuildParser(open(path, "r").read()).parse()
+        logging.debug("Parsed file %s without shell" % path)
+        count_parser("native")
+        return pkgdict
+    except UnsupportedSyntax as exp:
+        logging.debug("Unable to parse %s without shell: %s" % (path, exp))
+    count_parser("shell")
+    return parse_pkgbuild_shell(path, shell)
+
+def count_parser(parser, number=1):
+    '''
+    Count number PKGBUILDs parsed by parser in PARSERS and in the stats
+    of the running sync
+    '''
+    with PARSERS_LOCK:
+        PARSERS[parser] += number
+    count("pkgbuild %s" % parser, number)
+
+def parsers_summary():
+    '''Return a line of PKGBUILD counts by parser'''
+    with PARSERS_LOCK:
+        native, shell = PARSERS["native"], PARSERS["shell"]
+    total = native + shell
+    return "Parsed PKGBUILDs: %d native, %d with shell (%.0f%% native)" % (
+        native, shell, 100.0 * native / total if total > 0 else 0)
+
+def parse_pkgbuild_shell(path, shell="bash"):
     '''
     Source variable from a PKGBUILD
     Use bash to export vars
@@ -45,59 +95,379 @@ def parse_pkgbuild(path, shell="bash"):
         bashenv.pop(env, None)
     return bashenv
 
-def pkgbuild_set_version(path, version, reset=True):
+class PkgbuildParser(object):
+    '''
+    Static parser of PKGBUILD variables
+    Only handle assignments of strings and arrays, with simple variable
+    expansions ($var, ${var} and ${var[N]}). Function bodies are skipped.
+    Raise UnsupportedSyntax on any other shell construct.
+    '''
+
+    _assign = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)(\+?)=")
+    _function = re.compile(r"(?:function[ \t]+)?[-\w]+[ \t]*\(\)[ \t]*\{?")
+    _function_end = re.compile(r"^\}[ \t]*(?:#.*)?$", re.MULTILINE)
+    _closing_brace = re.compile(r"(?:^|[\s;&])\}[ \t]*(?:#.*)?$")
+    _expansion = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)(?:\[(\d+)\])?\}"
+                            r"|([A-Za-z_][A-Za-z0-9_]*)")
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.variables = {}
+
+    def parse(self):
+        '''
+        Return a dict of string variables of the PKGBUILD
+        Like sourcing, arrays are not returned and pkgname0 is set to the
+        first package name
+        '''
+        while self.skip_blanks(True):
+            match = self._assign.match(self.data, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                self.assign(match.group(1), match.group(2) == "+")
+                continue
+            match = self._function.match(self.data, self.pos)
+            if match is not None:
+                self.skip_function(match)
+                continue
+            raise UnsupportedSyntax("Unsupported statement at offset %d" % self.pos)
+        pkgdict = dict((k, v) for k, v in self.variables.items()
+                       if isinstance(v, str))
+        pkgname = self.variables.get("pkgname", "")
+        pkgdict["pkgname0"] = pkgname if isinstance(pkgname, str) else \
+            (pkgname[0] if len(pkgname) > 0 else "")
+        return pkgdict
+
+    def skip_blanks(self, newlines=False):
+        '''
+        Skip blanks, comments and, if asked, newlines and semicolons
+        Return False at the end of data
+        '''
+        blanks = " \t\n;" if newlines else " \t"
+        while self.pos < len(self.data):
+            char = self.data[self.pos]
+            if char in blanks:
+                self.pos += 1
+            elif self.data.startswith("\\\n", self.pos):
+                self.pos += 2
+            elif char == "#":
+                end = self.data.find("\n", self.pos)
+                self.pos = len(self.data) if end == -1 else end
+            else:
+                return True
+        return False
+
+    def skip_function(self, match):
+        '''
+        Skip a function body which ends by a closing brace alone on a line
+        Body lines must be indented and must not end by another closing
+        brace, otherwise the function end could be another one.
+        '''
+        eol = self.data.find("\n", match.end())
+        eol = len(self.data) if eol == -1 else eol
+        if "}" in self.data[match.end():eol]:
+            raise UnsupportedSyntax("Inline function at offset %d" % self.pos)
+        end = self._function_end.search(self.data, eol)
+        if end is None:
+            raise UnsupportedSyntax("Unterminated function at offset %d" % self.pos)
+        lines = self.data[eol:end.start()].split("\n")
+        # opening brace on the line after the function name
+        opened = match.group(0).endswith("{")
+        for line in lines:
+            if line[:1] not in ("", " ", "\t", "#"):
+                if opened or line.rstrip() != "{":
+                    raise UnsupportedSyntax("Unindented line in function at "
+                                            "offset %d" % self.pos)
+                opened = True
+            elif self._closing_brace.search(line):
+                raise UnsupportedSyntax("Closing brace in function at "
+                                        "offset %d" % self.pos)
+        self.pos = end.end()
+
+    def assign(self, name, append):
+        '''
+        Parse the value of an assignment to variable name
+        '''
+        if self.data.startswith("(", self.pos):
+            self.pos += 1
+            value = []
+            while True:
+                if not self.skip_blanks(True):
+                    raise UnsupportedSyntax("Unterminated array %s" % name)
+                if self.data.startswith(")", self.pos):
+                    self.pos += 1
+                    break
+                value.append(self.word(True))
+        else:
+            value = self.word(False)
+        # an assignment is a whole statement
+        self.skip_blanks()
+        if self.pos < len(self.data) and self.data[self.pos] not in "\n;":
+            raise UnsupportedSyntax("Unsupported command after %s" % name)
+        if append and name in self.variables:
+            previous = self.variables[name]
+            if isinstance(previous, list) and isinstance(value, list):
+                value = previous + value
+            elif isinstance(previous, str) and isinstance(value, str):
+                value = previous + value
+            else:
+                raise UnsupportedSyntax("Unsupported append to %s" % name)
+        self.variables[name] = value
+
+    def word(self, array):
+        '''
+        Parse a shell word
+        In arrays, words are not allowed to be split or globbed
+        '''
+        value = ""
+        while self.pos < len(self.data):
+            char = self.data[self.pos]
+            if char in " \t\n;" or (array and char == ")"):
+                break
+            self.pos += 1
+            if char == "'":
+                end = self.data.find("'", self.pos)
+                if end == -1:
+                    raise UnsupportedSyntax("Unterminated quote")
+                value += self.data[self.pos:end]
+                self.pos = end + 1
+            elif char == '"':
+                value += self.double_quoted()
+            elif char == "$":
+                expanded = self.expansion()
+                if array and re.search(r"\s", expanded):
+                    raise UnsupportedSyntax("Unsupported word splitting")
+                value += expanded
+            elif char == "\\":
+                if self.pos < len(self.data):
+                    if self.data[self.pos] != "\n":
+                        value += self.data[self.pos]
+                    self.pos += 1
+            elif char in "`|&<>(){}~" or (array and char in "*?["):
+                raise UnsupportedSyntax("Unsupported character %s" % char)
+            else:
+                value += char
+        return value
+
+    def double_quoted(self):
+        '''
+        Parse the content of a double quoted string
+        '''
+        value = ""
+        while self.pos < len(self.data):
+            char = self.data[self.pos]
+            self.pos += 1
+            if char == '"':
+                return value
+            elif char == "$":
+                value += self.expansion()
+            elif char == "`":
+                raise UnsupportedSyntax("Unsupported command substitution")
+            elif char == "\\" and self.pos < len(self.data):
+                escaped = self.data[self.pos]
+                self.pos += 1
+                if escaped in "$`\"\\":
+                    value += escaped
+                elif escaped != "\n":
+                    value += char + escaped
+            else:
+                value += char
+        raise UnsupportedSyntax("Unterminated double quote")
+
+    def expansion(self):
+        '''
+        Return the value of a variable expansion
+        Only variables defined in the PKGBUILD are expanded
+        '''
+        match = self._expansion.match(self.data, self.pos)
+        if match is None:
+            raise UnsupportedSyntax("Unsupported expansion at offset %d" % self.pos)
+        self.pos = match.end()
+        name = match.group(1) or match.group(3)
+        if name not in self.variables:
+            raise UnsupportedSyntax("Unknown variable %s" % name)
+        value = self.variables[name]
+        if isinstance(value, str):
+            value = [value]
+        index = int(match.group(2) or 0)
+        return value[index] if index < len(value) else ""
+
+def abs_index(abspath, cache=None):
     '''
-    Change PKGBUILD $pkgver to version
+    Return package names of an ABS tree indexed by repository
+    cache is a dict of previous indexes by ABS tree path. It is updated
+    and its repositories are only listed again when their mtime changed.
+    '''
+    if cache is None:
+        cache = {}
+    previous = cache.get(abspath, {})
+    current = {}
+    index = {}
+    for entry in os.scandir(abspath):
+        if not entry.is_dir():
+            continue
+        mtime = entry.stat().st_mtime
+        if previous.get(entry.name, {}).get("mtime") == mtime:
+            current[entry.name] = previous[entry.name]
+        else:
+            logging.debug("Indexing ABS directory %s" % entry.name)
+            current[entry.name] = {"mtime": mtime,
+                                   "packages": os.listdir(entry.path)}
+        index[entry.name] = set(current[entry.name]["packages"])
+    if current != previous:
+        cache[abspath] = current
+    return index
+
+def find_pkgbuilds(tree):
+    '''
+    Return paths of PKGBUILDs under directory tree, sorted
+    Hidden directories and makepkg src/pkg directories are skipped.
+    '''
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(tree):
+        pruned = set(name for name in dirnames if name.startswith("."))
+        if "PKGBUILD" in filenames:
+            paths.append(os.path.join(dirpath, "PKGBUILD"))
+            pruned |= set(("src", "pkg"))
+        dirnames[:] = sorted(name for name in dirnames if name not in pruned)
+    return sorted(paths)
+
+def pkgbuild_version(data, version, reset=True):
+    '''
+    Return PKGBUILD content data with $pkgver changed to version
     if a variable $_pkgver is present, this one will be updated instead of $pkgver
     If reset is True, $pkgrel will be set to 1
     '''
-    wspces = "[ \t\r\f\v]"
-    data = open(path, "r").read()
-    # prefer to replace $_pkgver
-    var = "pkgver" if re.search("^%s*_pkgver=" % wspces, data,
-        re.MULTILINE) is None else "_pkgver"
-    data = re.sub("^(%s*%s=).*$" % (wspces, var),
-        "\g<1>%s" % version, data, flags=re.MULTILINE)
+    values = {"pkgver": version}
+    for match in PKGBUILD_VERSION.finditer(data):
+        if match.group(2) == "_pkgver":
+            values = {"_pkgver": version}
+            break
     if reset:
-        data = re.sub("^(%s*pkgrel=).*" % wspces, "\g<1>1", data,
-            flags=re.MULTILINE)
-    open(path, "w").write(data)
+        values["pkgrel"] = "1"
+    # all assignments are replaced in one pass
+    return PKGBUILD_VERSION.sub(lambda match: match.group(1) + values[match.group(2)]
+                                if match.group(2) in values else match.group(0), data)
+
+def pkgbuild_set_version(path, version, reset=True):
+    '''
+    Change PKGBUILD $pkgver to version (see pkgbuild_version)
+    Return True if the PKGBUILD changed
+    '''
+    with open(path, "r") as fileobj:
+        data = fileobj.read()
+    newdata = pkgbuild_version(data, version, reset)
+    if newdata == data:
+        return False
+    with open(path, "w") as fileobj:
+        fileobj.write(newdata)
+    return True
 
 def pkgbuild_update_checksums(path):
     '''
     Update checksums of PKGBUILD
-    Use pacman provided scripts updpkgsums
+    Use pacman provided scripts updpkgsums, run in the PKGBUILD directory
+    Return the exit status and the output of updpkgsums
+    '''
+    logging.debug("Updating checksums of %s" % path)
+    try:
+        proc = subprocess.run(["updpkgsums", os.path.basename(path)],
+                              cwd=os.path.dirname(path) or ".",
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, close_fds=True)
+    except OSError as exp:
+        return 127, "Unable to run updpkgsums: %s\n" % exp
+    return proc.returncode, proc.stdout.decode("utf-8", "replace")
+
+def update_checksums(paths, jobs=1):
+    '''
+    Update checksums of PKGBUILDs, with jobs updpkgsums running at once
+    Return an iterator over path, exit status and output of updpkgsums, in
+    completion order
     '''
-    subprocess.check_call(["updpkgsums"], shell=False, close_fds=True)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = dict((executor.submit(pkgbuild_update_checksums, path), path)
+                       for path in paths)
+        for future in as_completed(futures):
+            status, output = future.result()
+            yield futures[future], status, output
 
 class Pacman(object):
     '''
     Cheap abstration of archlinux package manager
     This object is a singleton to avoid pyalpm to use too much memory
+    Access to pyalpm is serialized because it is not thread safe
     '''
 
     _instance = None
+    _lock = Lock()
 
     def __new__(cls, config="/etc/pacman.conf"):
         # singleton design pattern
-        if cls._instance is None:
-            cls._instance = object.__new__(cls)
-            cls._handle = pycman.config.PacmanConfig(config).initialize_alpm()
+        with cls._lock:
+            if cls._instance is None:
+                # pyalpm is loaded on first use, it is slow to initialize
+                import pycman.config
+                cls._instance = object.__new__(cls)
+                cls._handle = pycman.config.PacmanConfig(config).initialize_alpm()
+                cls._versions = {}
         return cls._instance
 
+    @classmethod
+    def reset(cls):
+        '''
+        Forget pyalpm handle and found versions
+        Databases are loaded again on next use, to see their updates
+        '''
+        with cls._lock:
+            cls._instance = None
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def parse_version(version):
+        '''
+        Split a pacman version into a tuple of epoch, pkgver and pkgrel
+        '''
+        return PACMAN_VERSION.match(version).groups()
+
     def find_pkg(self, name, repos=None):
         '''
         find a package named name in repos
         '''
-        if repos is None:
-            dbs = self._handle.get_syncdbs()
-        else:
-            dbs = [ db for db in self._handle.get_syncdbs() if db.name in repos ]
-        # looking into db for package name
-        for db in dbs:
-            pkg = db.get_pkg(name)
-            if pkg is not None:
-                return (db, pkg)
+        with self._lock:
+            if repos is None:
+                dbs = self._handle.get_syncdbs()
+            else:
+                dbs = [ db for db in self._handle.get_syncdbs() if db.name in repos ]
+            # looking into db for package name
+            for db in dbs:
+                pkg = db.get_pkg(name)
+                if pkg is not None:
+                    return (db, pkg)
         return (None, None)
 
+    def find_versions(self, names, repos=None):
+        '''
+        find versions of packages named names in repos
+        Return a dict of (db name, version) indexed by package name, or None
+        when a package is not found. Databases are walked once for all
+        names and results are kept for next calls.
+        '''
+        key = None if repos is None else tuple(repos)
+        with self._lock:
+            found = self._versions.setdefault(key, {})
+            missing = set(names) - set(found)
+            if len(missing) > 0:
+                for db in self._handle.get_syncdbs():
+                    if repos is not None and db.name not in repos:
+                        continue
+                    for pkg in db.pkgcache:
+                        if pkg.name in missing:
+                            found[pkg.name] = (db.name, pkg.version)
+                            missing.remove(pkg.name)
+                for name in missing:
+                    found[name] = None
+            return dict((name, found[name]) for name in names)
+
 # vim:set ts=4 sw=4 et ai:
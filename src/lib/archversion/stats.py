@@ -0,0 +1,188 @@
+# coding: utf-8
+
+# archversion - Archlinux Version Controller
+# Copyright © 2012 Sébastien Luttringer
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+'''Statistics Module'''
+
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock, local
+from time import monotonic
+import json
+import logging
+
+# Phases of a package sync
+PHASES = ("connect", "download", "regex", "eval", "downstream", "cache")
+
+class SyncStats(object):
+    '''
+    Timings of a sync
+    Durations of phases are recorded by package and by host. Timings
+    recorded by a thread are accounted to the package it syncs.
+    '''
+
+    # stats of the running sync
+    current = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self.packages = {}
+        self.hosts = {}
+        self.globals = Counter()
+        self.counters = Counter()
+        self.elapsed = 0.0
+
+    @contextmanager
+    def package(self, name):
+        '''
+        Account timings of the current thread to package name
+        The whole package sync time is recorded as its total
+        '''
+        self._local.name = name
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record("total", monotonic() - start)
+            self._local.name = None
+
+    @contextmanager
+    def timer(self, phase, host=None, name=None):
+        '''Record the duration of a phase'''
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, monotonic() - start, host, name)
+
+    def record(self, phase, seconds, host=None, name=None, size=0):
+        '''
+        Record the duration of a phase
+        Durations of requests on a host are accounted with their size.
+        Phases without package are accounted globally.
+        '''
+        if name is None:
+            name = getattr(self._local, "name", None)
+        with self._lock:
+            if name is None:
+                self.globals[phase] += seconds
+            else:
+                self.packages.setdefault(name, Counter())[phase] += seconds
+            if host is not None:
+                stats = self.hosts.setdefault(host, Counter())
+                stats[phase] += seconds
+                stats["bytes"] += size
+                if phase == "connect":
+                    stats["requests"] += 1
+
+    def count(self, counter, number=1):
+        '''Add number to counter'''
+        with self._lock:
+            self.counters[counter] += number
+
+    def merge(self, report):
+        '''
+        Add timings of a report, made by another process, to these stats
+        Elapsed time is not merged, processes run concurrently.
+        '''
+        with self._lock:
+            self.globals.update(report["globals"])
+            self.counters.update(report["counters"])
+            for host, stats in report["hosts"].items():
+                self.hosts.setdefault(host, Counter()).update(stats)
+            for name, timings in report["packages"].items():
+                self.packages.setdefault(name, Counter()).update(timings)
+
+    def slowest(self, count=10):
+        '''Return the count slowest packages with their timings'''
+        return sorted(self.packages.items(), key=lambda t: t[1]["total"],
+                      reverse=True)[:count]
+
+    def report(self):
+        '''Return timings as a json serializable dict'''
+        with self._lock:
+            return {
+                "elapsed": self.elapsed,
+                "globals": dict(self.globals),
+                "counters": dict(self.counters),
+                "hosts": dict((k, dict(v)) for k, v in self.hosts.items()),
+                "packages": dict((k, dict(v)) for k, v in self.packages.items()),
+            }
+
+    def save(self, path):
+        '''Save timings report as json into path'''
+        logging.debug("Saving sync stats into %s" % path)
+        with open(path, "w") as fileobj:
+            json.dump(self.report(), fileobj, indent=1, sort_keys=True)
+
+    def print_stats(self, count=10):
+        '''Print slowest packages and hosts totals'''
+        print("Sync time: %.3fs (%d packages)" % (self.elapsed, len(self.packages)))
+        for phase, seconds in sorted(self.globals.items()):
+            print("%s: %.3fs" % (phase, seconds))
+        for counter, number in sorted(self.counters.items()):
+            print("%s: %d" % (counter, number))
+        print()
+        print("%-24s %8s %s" % ("Package", "Total", " ".join(
+            "%10s" % phase for phase in PHASES)))
+        for name, timings in self.slowest(count):
+            print("%-24s %8.3f %s" % (name, timings["total"], " ".join(
+                "%10.3f" % timings[phase] for phase in PHASES)))
+        print()
+        print("%-32s %8s %10s %10s %12s" % ("Host", "Requests", "connect",
+                                            "download", "bytes"))
+        for host, stats in sorted(self.hosts.items(),
+                                  key=lambda t: t[1]["connect"] + t[1]["download"],
+                                  reverse=True):
+            print("%-32s %8d %10.3f %10.3f %12d" % (host, stats["requests"],
+                stats["connect"], stats["download"], stats["bytes"]))
+
+@contextmanager
+def _notimer():
+    yield
+
+def timer(phase, host=None, name=None):
+    '''
+    Return a context manager recording a phase duration in the stats of
+    the running sync, if any
+    '''
+    if SyncStats.current is None:
+        return _notimer()
+    return SyncStats.current.timer(phase, host, name)
+
+def package(name):
+    '''
+    Return a context manager accounting timings of the current thread to
+    package name in the stats of the running sync, if any
+    '''
+    if SyncStats.current is None:
+        return _notimer()
+    return SyncStats.current.package(name)
+
+def record(phase, seconds, host=None, name=None, size=0):
+    '''Record a phase duration in the stats of the running sync, if any'''
+    if SyncStats.current is not None:
+        SyncStats.current.record(phase, seconds, host, name, size)
+
+def count(counter, number=1):
+    '''Add number to a counter in the stats of the running sync, if any'''
+    if SyncStats.current is not None:
+        SyncStats.current.count(counter, number)
+
+# vim:set ts=4 sw=4 et ai:
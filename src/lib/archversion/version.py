@@ -20,50 +20,127 @@
 '''Version Module'''
 
 
-from archversion import HTTP_HEADERS, CONFIG_PACKAGES, CACHE_PACKAGES
-from archversion.config import BaseConfigFile
-from archversion.database import JsonDatabase
-from archversion.error import InvalidConfigFile, VersionNotFound
-from archversion.pacman import parse_pkgbuild, Pacman
-from collections import OrderedDict
-from time import time
-from urllib.request import urlopen, Request
+from archversion import CONFIG_PACKAGES, CACHE_PACKAGES, CACHE_ABS
+from archversion import CACHE_PACKAGES_SQLITE
+from archversion import AUR_RPC_URL, AUR_RPC_MAX_LENGTH
+from archversion import ARCHWEB_URL, ARCHWEB_INDEX_MIN
+from archversion.config import PackagesConfigFile
+from archversion.database import JsonDatabase, SqliteDatabase
+from archversion.error import BaseError, InvalidConfigFile, NotModified
+from archversion.error import VersionNotFound
+from archversion.network import HttpClient, UrlCache
+from archversion.pacman import abs_index, parse_pkgbuild, Pacman
+from archversion.pacman import PARSERS, PARSERS_LOCK, count_parser, parsers_summary
+from archversion.stats import SyncStats, package, record, timer
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, time
+from urllib.parse import quote, urlsplit
+import codecs
 import fnmatch
+import hashlib
 import json
 import logging
 import os
 import re
 import subprocess
 import sys
+import zlib
+
+# Maximum length of upstream regex matches, in characters
+SCAN_OVERLAP = 4096
 
 class VersionController(object):
     '''
     Handle version detection of packages
     '''
 
-    def __init__(self):
-        # load packages configuration
-        self._packages = BaseConfigFile(CONFIG_PACKAGES)
-        # load cache database
-        self._cache = JsonDatabase()
-        self._cache.load(CACHE_PACKAGES)
+    def __init__(self, cache="json"):
+        # packages configuration and cache are loaded on first use
+        self._cache_type = cache
+        self._config = None
+        self._database = None
+        self._statuses = None
+        self._lock = Lock()
+        # downstream indexes of the current sync
+        self._indexes = {}
+
+    @property
+    def _packages(self):
+        '''Packages configuration, loaded on first access'''
+        if self._config is None:
+            self._config = PackagesConfigFile(CONFIG_PACKAGES)
+        return self._config
+
+    @property
+    def _cache(self):
+        '''Cache database, loaded on first access'''
+        with self._lock:
+            if self._database is None:
+                self._database = self.load_cache(self._cache_type)
+        return self._database
+
+    @staticmethod
+    def load_cache(cache):
+        '''Return the cache database of type cache'''
+        if cache == "sqlite":
+            database = SqliteDatabase()
+            database.load(CACHE_PACKAGES_SQLITE)
+        else:
+            database = JsonDatabase()
+            database.load(CACHE_PACKAGES)
         # set cache
-        if set(self._cache.keys()) != set(("downstream", "compare", "upstream")):
+        if not set(("downstream", "compare", "upstream")) <= set(database.keys()):
             logging.debug("Invalid cache, purging it")
-            self._cache.clear()
-            self._cache["upstream"] = {}
-            self._cache["downstream"] = {}
-            self._cache["compare"] = {}
+            database.clear()
+            database["upstream"] = {}
+            database["downstream"] = {}
+            database["compare"] = {}
+        # compare status index, rebuilt from versions when missing
+        if not set(("status", "fresh")) <= set(database.keys()):
+            database["status"] = {}
+            database["fresh"] = {}
+        return database
+
+    def reload(self):
+        '''
+        Forget loaded config and cache, they are loaded again on next access
+        Unsaved cache changes are lost.
+        '''
+        with self._lock:
+            if self._database is not None:
+                self._database.close()
+            self._config = None
+            self._database = None
+            self._statuses = None
+
+    def load(self):
+        '''Load config and cache now, instead of on first access'''
+        self._packages
+        self._cache
+
+    def save(self):
+        '''Save the cache'''
+        self._cache.save()
 
     @property
     def packages(self):
         '''Return list of packages augmented with aliases'''
         pkgs = []
-        for name, data in self._packages.items():
+        aliases = self._packages.aliases
+        for name in self._packages:
             pkgs.append(name)
-            pkgs += self.alias(data)
+            pkgs += aliases[name]
         return pkgs
 
+    def section(self, name):
+        '''Return the package name of a package or alias name or None'''
+        section = self._packages.index.get(name)
+        if section not in self._packages:
+            return None
+        return section
+
     @property
     def versions(self):
         '''Return upstream versions of a package (use cache)'''
@@ -77,99 +154,385 @@ class VersionController(object):
         Remove packages not listed in packages from the processing of
         controller future actions
         '''
-        packages = set(packages)
-        for name, data in OrderedDict(self._packages).items():
-            names = set((name,)) | set(self.alias(data))
-            if len(packages & names) == 0:
-                self._packages.pop(name, None)
+        index = self._packages.index
+        keep = set(index[name] for name in packages if name in index)
+        for name in list(self._packages):
+            if name not in keep:
+                self._packages.pop(name)
 
     def sort(self):
         '''
         Sort packages by name
         Make packages to be upgraded/displayed by alpha order
         '''
-        self._packages = self.sort_dict(self._packages)
+        # sort in place to keep compiled configuration
+        for name in sorted(self._packages):
+            self._packages.move_to_end(name)
         # do not sort self._cache by recreating the cache object
         # destructor is used to save the cache content
 
-    def sync(self):
+    def sync(self, jobs=1, host_jobs=2, force=False, stats=None, processes=1,
+             shard="host"):
         '''
         Synchronise local cache with external states
         Retrieve upstream and downstream versions and store them
+
+        Versions are retrieved by jobs concurrent threads, with at most
+        host_jobs concurrent requests per host. They are stored in cache
+        in packages order.
+        Upstream urls shared by several packages are fetched once.
+        Upstreams checked recently are not fetched, unless force is True.
+        Timings are recorded into stats, a SyncStats object, when given.
+
+        With several processes, packages are split in shards by url host or
+        by name, synced by worker processes, and their versions are stored
+        at once when all shards are synced.
+        '''
+        HttpClient.host_jobs = max(host_jobs, 1)
+        SyncStats.current = stats
+        start = monotonic()
+        try:
+            if processes > 1:
+                self._sync_sharded(jobs, host_jobs, force, processes, shard)
+            else:
+                self._sync(jobs, force)
+            if sum(PARSERS.values()) > 0:
+                logging.debug(parsers_summary())
+            if stats is not None:
+                # save now to account the cache write
+                with timer("cache save"):
+                    self._cache.save()
+        finally:
+            SyncStats.current = None
+            if stats is not None:
+                stats.elapsed = monotonic() - start
+
+    def _sync(self, jobs, force):
+        '''
+        Synchronise versions of packages with jobs concurrent threads
+        '''
+        self._indexes = self.index_downstream()
+        for name, versions in self.sync_versions(jobs, force):
+            self.cache_versions(name, versions)
+
+    def _sync_sharded(self, jobs, host_jobs, force, processes, shard):
+        '''
+        Synchronise versions of packages with processes worker processes
+        Host limits (host_jobs and host_rate) are enforced by each process.
+        '''
+        # multiprocessing is only loaded by sharded syncs
+        from concurrent.futures import ProcessPoolExecutor
+        compiled = self._packages.compiled
+        if shard == "name" and any(compiled[name]["policy"].host_rate > 0
+                                   for name in self._packages):
+            raise BaseError("Sharding by name would multiply host_rate by "
+                            "the number of processes, shard by host")
+        self._indexes = self.index_downstream()
+        shards = self.shards(processes, shard)
+        logging.debug("Syncing %d shards of %s packages" % (len(shards),
+            ", ".join(str(len(names)) for names in shards)))
+        results = {}
+        # workers must not use connections kept alive by downstream indexing
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=HttpClient.reset) as executor:
+            futures = [ executor.submit(VersionController.sync_shard,
+                                        self._cache_type, names, self._indexes,
+                                        jobs, host_jobs, force,
+                                        SyncStats.current is not None)
+                        for names in shards ]
+            try:
+                for future in futures:
+                    versions, parsers, report = future.result()
+                    results.update(versions)
+                    for parser, number in parsers.items():
+                        count_parser(parser, number)
+                    # timings recorded by the worker are only in its memory
+                    if report is not None:
+                        SyncStats.current.merge(report)
+            finally:
+                for future in futures:
+                    future.cancel()
+        # store versions at once in packages order
+        with self._cache.batch():
+            for name in self._packages:
+                if name in results:
+                    self.cache_versions(name, results[name])
+
+    def shards(self, count, shard="host"):
+        '''
+        Split package names in at most count shards
+        Packages are assigned by a stable hash of their url host or name.
+        Sharding by host keeps packages sharing an url or a host in the same
+        worker, so shared urls are fetched once and host limits apply.
+        '''
+        if shard not in ("host", "name"):
+            raise ValueError("Invalid shard mode: %s" % shard)
+        shards = [ [] for _ in range(count) ]
+        for name, value in self._packages.items():
+            key = urlsplit(value.get("url", "")).netloc if shard == "host" else name
+            shards[zlib.crc32(key.encode()) % count].append(name)
+        return [ names for names in shards if len(names) > 0 ]
+
+    @staticmethod
+    def sync_shard(cache, names, indexes, jobs, host_jobs, force, stats=False):
+        '''
+        Return versions of packages names, synced in a worker process, counts
+        of PKGBUILDs parsed meanwhile by parser and, when stats is True, the
+        report of the sync timings
+        Downstream indexes are computed by the parent, which stores versions.
+        '''
+        HttpClient.host_jobs = max(host_jobs, 1)
+        # don't record into the copy of the parent stats inherited by fork
+        SyncStats.current = SyncStats() if stats else None
+        vctrl = VersionController(cache)
+        vctrl.select(names)
+        vctrl._indexes = indexes
+        with PARSERS_LOCK:
+            before = Counter(PARSERS)
+        try:
+            versions = list(vctrl.sync_versions(jobs, force))
+            report = SyncStats.current.report() if stats else None
+            with PARSERS_LOCK:
+                return (versions, dict(PARSERS - before), report)
+        finally:
+            SyncStats.current = None
+            # the cache is written by the parent
+            vctrl.reload()
+
+    def sync_versions(self, jobs, force):
+        '''
+        Return an iterator over packages names and their synced versions,
+        in packages order. Packages are synced by jobs concurrent threads.
+        '''
+        urls = Counter(value.get("url") for value in self._packages.values())
+        fetcher = UrlCache(url for url, count in urls.items() if count > 1)
+        executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        futures = [ (name, executor.submit(self.sync_package, name, value,
+                                           fetcher, force))
+                    for name, value in self._packages.items() ]
+        try:
+            for name, future in futures:
+                yield (name, future.result())
+        finally:
+            # don't wait pending packages when interrupted
+            for name, future in futures:
+                future.cancel()
+            executor.shutdown()
+        logging.debug("Shared urls: %d fetches, %d saved" % (fetcher.fetched,
+                                                            fetcher.saved))
+
+    def cache_versions(self, name, versions):
+        '''Save synced versions of a package in cache'''
+        with timer("cache", name=name):
+            if "upstream" in versions:
+                self.cache_version("upstream", name, versions["upstream"],
+                                   versions["meta"])
+            if "downstream" in versions:
+                self.cache_version("downstream", name, versions["downstream"])
+
+    def sync_package(self, name, value, fetcher=None, force=False):
+        '''
+        Retrieve upstream and downstream versions of a package
+        fetcher is used to retrieve upstream pages (default HttpClient)
+        Return a dict of found versions indexed by upstream/downstream
+        and upstream check metadata
+        '''
+        with package(name):
+            return self._sync_package(name, value, fetcher, force)
+
+    def _sync_package(self, name, value, fetcher, force):
+        '''
+        Retrieve upstream and downstream versions of a package
+        '''
+        versions = {}
+        try:
+            logging.debug("Syncing versions of package %s" % name)
+            # upstream metadata are only valid with the same config
+            cached = dict(self._cache["upstream"].get(name, {}))
+            config = self.config_hash(value)
+            if "version" not in cached or cached.get("config") != config:
+                cached = {}
+            compiled = self._packages.compiled[name]
+            meta = {"config": config, "checked": int(time())}
+            if not force and self.is_fresh(cached, compiled):
+                logging.debug("%s: upstream checked recently" % name)
+                v_upstream = cached["version"]
+                fetched = cached
+                meta["checked"] = cached["checked"]
+            else:
+                try:
+                    # get upstream version
+                    v_upstream, fetched = self.get_version_upstream(name, value,
+                        cached, fetcher, compiled)
+                    # apply eval to upstream
+                    e_upstream = compiled.get("eval_upstream", None)
+                    if e_upstream is not None:
+                        with timer("eval"):
+                            v_upstream = eval(e_upstream, {"re": re},
+                                              {"version": v_upstream})
+                        logging.debug("eval_upstream produce version: %s" % v_upstream)
+                except NotModified:
+                    logging.debug("%s: upstream not modified" % name)
+                    v_upstream = cached["version"]
+                    fetched = cached
+            versions["upstream"] = v_upstream
+            for key in ("etag", "modified"):
+                if key in fetched:
+                    meta[key] = fetched[key]
+            versions["meta"] = meta
+            # get downstream mode
+            mode = value.get("downstream", None)
+            if mode is None:
+                logging.warning("%s: Invalid downstream mode: %s." % (name, mode))
+                return versions
+            # get downstream version
+            with timer("downstream"):
+                v_downstream = self.get_version_downstream(name, value, mode,
+                                                           self._indexes.get(mode))
+            # apply eval to downstream
+            e_downstream = compiled.get("eval_downstream", None)
+            if e_downstream is not None:
+                with timer("eval"):
+                    v_downstream = eval(e_downstream, {"re": re},
+                                        {"version": v_downstream})
+                logging.debug("eval_downstream produce version: %s" % v_downstream)
+            versions["downstream"] = v_downstream
+        except Exception as exp:
+            logging.error("Sync of %s: %s" % (name, exp))
+        return versions
+
+    def index_downstream(self):
         '''
+        Build downstream indexes of packages
+        Modes able to resolve many packages at once provide an
+        index_downstream_<mode> method. Return a dict of indexes by mode.
+        '''
+        modes = OrderedDict()
         for name, value in self._packages.items():
+            modes.setdefault(value.get("downstream", None), []).append((name, value))
+        indexes = {}
+        for mode, packages in modes.items():
+            func = getattr(self, "index_downstream_%s" % mode, None)
+            if func is None:
+                continue
+            logging.debug("Indexing %d %s packages" % (len(packages), mode))
             try:
-                logging.debug("Syncing versions of package %s" % name)
-                # get upstream version
-                v_upstream = self.get_version_upstream(name, value)
-                # apply eval to upstream
-                e_upstream = value.get("eval_upstream", None)
-                if e_upstream is not None:
-                    v_upstream = eval(e_upstream, {"re": re}, {"version": v_upstream})
-                    logging.debug("eval_upstream produce version: %s" % v_upstream)
-                # save upstream version
-                if self._cache["upstream"].get(name, {}).get("version", None) != v_upstream:
-                    logging.debug("caching upstream version %s" % v_upstream)
-                    self._cache["upstream"][name] = {"version": v_upstream, "epoch": int(time())}
-                else:
-                    logging.debug("already cached upstream version %s" % v_upstream)
-                # get downstream mode
-                mode = value.get("downstream", None)
-                if mode is None:
-                    logging.warning("%s: Invalid downstream mode: %s." % (name, mode))
-                    continue
-                # get downstream version
-                v_downstream = self.get_version_downstream(name, value, mode)
-                # apply eval to downstream
-                e_downstream = value.get("eval_downstream", None)
-                if e_downstream is not None:
-                    v_downstream = eval(e_downstream, {"re": re}, {"version": v_downstream})
-                    logging.debug("eval_downstream produce version: %s" % v_downstream)
-                # save downstream version
-                if self._cache["downstream"].get(name, {}).get("version", None) != v_downstream:
-                    logging.debug("caching downstream version %s" % v_downstream)
-                    self._cache["downstream"][name] = {"version": v_downstream, "epoch": int(time())}
-                else:
-                    logging.debug("already cached downstream version %s" % v_downstream)
+                with timer("index %s" % mode):
+                    indexes[mode] = func(packages)
             except Exception as exp:
-                logging.error("Sync of %s: %s" % (name, exp))
+                logging.warning("Unable to index %s downstream: %s" % (mode, exp))
+        return indexes
+
+    def cache_version(self, way, name, version, meta=None):
+        '''
+        Save a version in the upstream or downstream cache
+        meta are stored next to the version. They are upstream check
+        metadata used on next sync: config fingerprint, check time and
+        cache validators.
+        '''
+        cached = self._cache[way].get(name, {})
+        if cached.get("version", None) != version:
+            logging.debug("%s: caching %s version %s" % (name, way, version))
+            entry = {"version": version, "epoch": int(time())}
+        else:
+            logging.debug("%s: already cached %s version %s" % (name, way, version))
+            entry = dict((k, v) for k, v in cached.items()
+                         if k not in ("config", "checked", "etag", "modified"))
+        if meta is not None:
+            entry.update(meta)
+        # only write changed entries
+        if entry != cached:
+            self._cache[way][name] = entry
+            self.index_status(name, self.status(name))
+
+    def status(self, name):
+        '''
+        Return the compare status of a package from cache
+        Status is a tuple of upstream and downstream versions, if they
+        differ (outdated), if they changed since last compare (fresh) and
+        the epoch of the last change.
+        '''
+        upstream = self._cache["upstream"].get(name, {})
+        downstream = self._cache["downstream"].get(name, {})
+        v_upstream = upstream.get("version", None)
+        v_downstream = downstream.get("version", None)
+        epoch = max(upstream.get("epoch", 0), downstream.get("epoch", 0))
+        fresh = self._cache["compare"].get(name, -1) < epoch
+        return (v_upstream, v_downstream, v_upstream != v_downstream, fresh, epoch)
+
+    def index_status(self, name, status):
+        '''
+        Store the compare status of a package in the status index
+        The index is made of the status table, with statuses of packages,
+        and the fresh table, with change epochs of fresh packages only.
+        '''
+        status = list(status)
+        if self._cache["status"].get(name) != status:
+            self._cache["status"][name] = status
+        if self._statuses is not None:
+            self._statuses[name] = status
+        fresh = self._cache["fresh"]
+        if status[3]:
+            if fresh.get(name) != status[4]:
+                fresh[name] = status[4]
+        elif name in fresh:
+            del fresh[name]
+
+    @property
+    def _status(self):
+        '''
+        Compare status of packages by name, read from the status index on
+        first access. Statuses missing from the index are computed and
+        stored. Statuses are updated when versions are cached or compared.
+        '''
+        if self._statuses is None:
+            self._statuses = dict(self._cache["status"].items())
+            for name in self._packages:
+                if name not in self._statuses:
+                    self.index_status(name, self.status(name))
+        return self._statuses
 
-    def compare(self, only_new=False, only_fresh=False):
+    def compare(self, only_new=False, only_fresh=False, record=True):
         '''
         Compare versions according compare mode
         Return an iterator over all packages and their aliases with
         upstream and downstream versions.
+        When record is True, compared versions are marked in cache, so they
+        are no more fresh. Unchanged marks are not written again.
         '''
-        for name, value in self._packages.items():
+        statuses = self._status
+        # only fresh packages are looked up in fresh mode
+        fresh_names = set(self._cache["fresh"]) if only_fresh else None
+        for name in self._packages:
+            if fresh_names is not None and name not in fresh_names:
+                continue
             logging.debug("Comparing versions of package %s" % name)
+            v_upstream, v_downstream, outdated, fresh, epoch = statuses[name]
             # get upstream in cache
-            v_upstream = self._cache["upstream"].get(name, {}).get("version", None)
             if v_upstream is None:
                 logging.warning("%s: Upstream version not found in cache" % name)
                 continue
             # get downstream in cache
-            v_downstream = self._cache["downstream"].get(name, {}).get("version", None)
             if v_downstream is None:
                 logging.warning("%s: Downstream version not found in cache" % name)
                 continue
             # only new version mode
-            if only_new and v_upstream == v_downstream:
+            if only_new and not outdated:
                 logging.debug("%s: skipped by only new mode" % name)
                 continue
             # only fresh version mode
-            if only_fresh:
-                last_cmp = self._cache["compare"].get(name, -1)
-                last_up = self._cache["upstream"].get(name, {}).get("epoch", 0)
-                last_down = self._cache["downstream"].get(name, {}).get("epoch", 0)
-                if (last_cmp >= last_up and last_cmp >= last_down):
-                    logging.debug("%s: skipped by only fresh mode" % name)
-                    continue
+            if only_fresh and not fresh:
+                logging.debug("%s: skipped by only fresh mode" % name)
+                continue
             # save our compare in cache
-            self._cache["compare"][name] = int(time())
+            if record and fresh:
+                self._cache["compare"][name] = epoch
+                self.index_status(name, (v_upstream, v_downstream, outdated,
+                                         False, epoch))
             # gen main pacakge
             yield (name, v_upstream, v_downstream)
             # gen aliases package
-            for alias in self.alias(value):
+            for alias in self._packages.aliases[name]:
                 yield (alias, v_upstream, v_downstream)
 
     @staticmethod
@@ -183,101 +546,267 @@ class VersionController(object):
         return OrderedDict(sorted(larousse.items(), key=lambda t: t[0]))
 
     @staticmethod
-    def get_version_upstream(name, value):
-        '''Fetch upstream version'''
+    def is_fresh(cached, compiled):
+        '''
+        Return True if a cached upstream was checked recently
+        Upstreams are checked every check_interval. With check_backoff,
+        this interval grows with the time since last upstream release, up
+        to check_interval_max.
+        '''
+        if "checked" not in cached:
+            return False
+        released = cached["checked"] - cached.get("epoch", cached["checked"])
+        interval = max(compiled["check_interval"],
+                       min(compiled["check_interval_max"],
+                           compiled["check_backoff"] * released))
+        return time() - cached["checked"] < interval
+
+    @staticmethod
+    def config_hash(value):
+        '''Return a fingerprint of a package config'''
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_version_upstream(name, value, validators=None, fetcher=None,
+                             compiled=None):
+        '''
+        Fetch upstream version
+        Return a tuple of the version and the upstream cache validators
+        Raise NotModified if upstream didn't change since validators
+        fetcher is used to retrieve the upstream page (default HttpClient)
+        compiled are the package compiled regex (default compiled from value)
+        '''
         logging.debug("Get upstream version")
         # check upstream param
         if "url" not in value:
             logging.error("No url specified for %s" % name)
             raise InvalidConfigFile("Missing url in config file")
         url = value["url"]
-        regex = value.get("regex", "%s[-_]v?(%s)%s" % (
-                    value.get("regex_name", name),
-                    value.get("regex_version", "[-.\w]+"),
-                    value.get("regex_ext",
-                              "\.(?:tar(?:\.gz|\.bz2|\.xz)?|tgz|tbz2|zip)")))
+        if compiled is None:
+            compiled = PackagesConfigFile.compile(name, value)
+        regex = compiled["regex"]
+        regex_exclude = compiled["regex_exclude"]
         # retrieve config timeout
         timeout = float(value["timeout"]) if "timeout" in value else None
-        # do it retry time + 1
-        ntry = int(value.get("retry", 0)) + 1
+        # retrieve scanning limits
+        max_bytes = int(value["max_bytes"]) if "max_bytes" in value else None
+        max_matches = int(value["max_matches"]) if "max_matches" in value else None
+        fetcher = fetcher or HttpClient()
+        headers = HttpClient.conditional_headers(validators or {})
+        policy = compiled["policy"]
+        def fetch():
+            '''Return found versions and the stream of the scanned page'''
+            # a failed scan is retried from the start of the page
+            with fetcher.open(url, timeout, headers,
+                              policy._replace(retry=0)) as stream:
+                if stream.status == 304:
+                    raise NotModified()
+                logging.debug("Version regex: %s" % regex.pattern)
+                start = monotonic()
+                v = VersionController.scan(regex, stream, max_bytes, max_matches)
+                # scanning time without download time
+                record("regex", monotonic() - start - stream.elapsed)
+            return (v, stream)
         # do the job
-        for n in range(1, ntry + 1):
-            try:
-                logging.debug("Requesting url: %s (try %d/%d)" % (url, n, ntry))
-                logging.debug("Timeout is %s" % timeout)
-                url_req = Request(url, headers=HTTP_HEADERS)
-                url_fd = urlopen(url_req, timeout=timeout)
-                logging.debug("Version regex: %s" % regex)
-                v = re.findall(regex, url_fd.read().decode("utf-8", "ignore"))
-                if v is None or len(v) == 0:
-                    raise VersionNotFound("No regex match on upstream")
-                # remove duplicity
-                v = set(v)
-                # list all found versions
-                logging.debug("Found versions: %s" % v)
-                # exclude versions
-                regex_exclude = value.get("regex_exclude", ".*(rc|beta|alpha|pre).*")
-                if regex_exclude != "":
-                    logging.debug("Exclusion regex: %s" % regex_exclude)
-                    v -= set(filter(lambda x: re.search(regex_exclude, x), v))
-                    logging.debug("Found versions after exclusion: %s" % v)
-                # latest version is the highest
-                v = max(v, key=VersionKey)
-                # list selected version
-                logging.debug("Upstream version is : %s" % v)
-                return v
-            except Exception as exp:
-                if n == ntry:
-                    raise VersionNotFound("Upstream check failed: %s" % exp)
-        assert(False)
+        try:
+            v, stream = HttpClient().retry(url, policy, fetch)
+            if v is None or len(v) == 0:
+                raise VersionNotFound("No regex match on upstream")
+            # remove duplicity
+            v = set(v)
+            # list all found versions
+            logging.debug("Found versions: %s" % v)
+            # exclude versions
+            if regex_exclude is not None:
+                logging.debug("Exclusion regex: %s" % regex_exclude.pattern)
+                v -= set(filter(regex_exclude.search, v))
+                logging.debug("Found versions after exclusion: %s" % v)
+            # latest version is the highest
+            v = max(v, key=VersionKey)
+            # list selected version
+            logging.debug("Upstream version is : %s" % v)
+            return (v, HttpClient.validators(stream))
+        except NotModified:
+            raise
+        except Exception as exp:
+            raise VersionNotFound("Upstream check failed: %s" % exp)
 
     @staticmethod
-    def get_version_downstream(name, value, mode):
-        '''Return dowstream version'''
+    def scan(regex, chunks, max_bytes=None, max_matches=None):
+        '''
+        Return the list of regex matches in chunks of utf-8 data
+        Matches are like findall ones and can span over chunks. They must
+        be shorter than SCAN_OVERLAP characters.
+        Scanning stops after max_bytes of data or max_matches matches.
+        '''
+        decoder = codecs.getincrementaldecoder("utf-8")("ignore")
+        matches = []
+        buf = ""
+        pos = size = 0
+        eof = False
+        chunks = iter(chunks)
+        while not eof:
+            chunk = next(chunks, None)
+            if chunk is not None and max_bytes is not None:
+                if size + len(chunk) >= max_bytes:
+                    logging.debug("Scanning stopped after %d bytes" % max_bytes)
+                    chunk = chunk[:max_bytes - size]
+                    eof = True
+                size += len(chunk)
+            if chunk is None:
+                eof = True
+                buf += decoder.decode(b"", True)
+            else:
+                buf += decoder.decode(chunk)
+            # matches near the end of data could continue in next chunk
+            limit = len(buf) if eof else len(buf) - SCAN_OVERLAP
+            for match in regex.finditer(buf, pos):
+                if match.end() > limit:
+                    break
+                if regex.groups == 0:
+                    matches.append(match.group(0))
+                elif regex.groups == 1:
+                    matches.append(match.group(1))
+                else:
+                    matches.append(match.groups())
+                pos = match.end()
+                if max_matches is not None and len(matches) >= max_matches:
+                    logging.debug("Scanning stopped after %d matches" % max_matches)
+                    return matches
+            # matches are shorter than overlap, so nothing can start before
+            cut = max(pos, limit - SCAN_OVERLAP)
+            if cut > 0:
+                buf = buf[cut:]
+                pos = max(pos - cut, 0)
+        return matches
+
+    @staticmethod
+    def get_version_downstream(name, value, mode, index=None):
+        '''
+        Return dowstream version
+        index is the downstream index of the mode, if any
+        '''
         try:
-            return getattr(VersionController, "get_version_downstream_%s" % mode)(name, value)
+            func = getattr(VersionController, "get_version_downstream_%s" % mode)
         except AttributeError:
             raise InvalidConfigFile("Invalid dowstream mode")
+        if index is None:
+            return func(name, value)
+        return func(name, value, index)
+
+    @staticmethod
+    def index_downstream_pacman(packages):
+        '''
+        Return pacman versions indexed by package name
+        Packages sharing the same repo filter are found in one walk of
+        the sync databases
+        '''
+        groups = OrderedDict()
+        for name, value in packages:
+            groups.setdefault(value.get("repo", None), []).append(name)
+        index = {}
+        for repo, names in groups.items():
+            allowed_repos = repo.split(",") if repo is not None else None
+            index.update(Pacman().find_versions(names, allowed_repos))
+        return index
 
     @staticmethod
-    def get_version_downstream_pacman(name, value):
-        '''Return pacman version'''
+    def get_version_downstream_pacman(name, value, index=None):
+        '''
+        Return pacman version
+        Version is looked up in the pacman index or in databases when
+        there is no index
+        '''
         logging.debug("Get pacman version")
-        # Load pacman
-        pacman = Pacman()
-        # filter if repo is provided
-        allowed_repos = value.get("repo").split(",") if "repo" in value else None
-        # looking into db for package name
-        db, pkg = pacman.find_pkg(name, allowed_repos)
-        if pkg is not None:
-            epoch, pkgver, pkgrel = re.match("^(?:(\d+)\:)?([^-:]*)(?:-(\d+))?",
-                pkg.version).groups()
-            logging.debug("pacman version in %s: %s" % (db.name, pkgver))
+        if index is not None and name in index:
+            found = index[name]
+        else:
+            # filter if repo is provided
+            allowed_repos = value.get("repo").split(",") if "repo" in value else None
+            # looking into db for package name
+            db, pkg = Pacman().find_pkg(name, allowed_repos)
+            found = (db.name, pkg.version) if pkg is not None else None
+        if found is not None:
+            epoch, pkgver, pkgrel = Pacman.parse_version(found[1])
+            logging.debug("pacman version in %s: %s" % (found[0], pkgver))
             return pkgver
         raise VersionNotFound("No pacman package found")
 
     @staticmethod
-    def get_version_downstream_archweb(name, value):
-        '''Return archweb version'''
+    def archweb_archs(value):
+        '''Return the list of archweb archs of a package'''
+        return value.get("arch", "x86_64,i686,any").split(",")
+
+    @staticmethod
+    def archweb_repos(value):
+        '''Return the list of archweb repositories of a package'''
+        return value.get("repo",
+                         "community-testing,community,testing,extra,core"
+                         ).split(",")
+
+    @staticmethod
+    def index_downstream_archweb(packages):
+        '''
+        Return archweb packages indexed by name
+        Each name is associated to a dict of versions by (repo, arch)
+        The archweb search is walked page by page once for all archs of
+        packages. Return None when there is not enough packages to worth it.
+        '''
+        if len(packages) < ARCHWEB_INDEX_MIN:
+            return None
+        archs = set()
+        for name, value in packages:
+            archs.update(VersionController.archweb_archs(value))
+        # retrieve config timeout and network policy
+        value = packages[0][1]
+        timeout = float(value["timeout"]) if "timeout" in value else None
+        policy = PackagesConfigFile.policy(value)
+        base = "%s/search/json/?%s" % (ARCHWEB_URL,
+            "&".join("arch=%s" % quote(arch) for arch in sorted(archs)))
+        index = {}
+        page = num_pages = 1
+        while page <= num_pages:
+            data = HttpClient().get("%s&page=%d" % (base, page), timeout,
+                                    policy=policy).data
+            d = json.loads(data.decode("utf-8", "ignore"))
+            for result in d["results"]:
+                index.setdefault(result["pkgname"], {})[
+                    (result["repo"].lower(), result["arch"])] = result["pkgver"]
+            num_pages = d["num_pages"]
+            page += 1
+        logging.debug("Archweb indexed %d packages in %d requests" % (
+            len(index), num_pages))
+        return index
+
+    @staticmethod
+    def get_version_downstream_archweb(name, value, index=None):
+        '''
+        Return archweb version
+        Version is looked up in the archweb index or probed in each
+        repository of each arch when there is no index
+        '''
         logging.debug("Get archweb version")
         # if arch is specified
-        archs = value.get("arch", "x86_64,i686,any").split(",")
+        archs = VersionController.archweb_archs(value)
         # if archweb repository is specified
-        repos = value.get("repo",
-                          "community-testing,community,testing,extra,core"
-                          ).split(",")
-        # retrieve config timeout
+        repos = VersionController.archweb_repos(value)
+        if index is not None:
+            for arch in archs:
+                for repo in repos:
+                    v = index.get(name, {}).get((repo, arch), None)
+                    if v is not None:
+                        logging.debug("Archweb version is : %s" % v)
+                        return v
+            raise VersionNotFound("No Archweb package found")
+        # retrieve config timeout and network policy
         timeout = float(value["timeout"]) if "timeout" in value else None
+        policy = PackagesConfigFile.policy(value)
         for arch in archs:
             for repo in repos:
-                url = "http://www.archlinux.org/packages/%s/%s/%s/json" % (
-                    repo, arch, name)
-                url_req = Request(url, headers=HTTP_HEADERS)
-                logging.debug("Requesting url: %s" % url)
-                logging.debug("Timeout is %s" % timeout)
+                url = "%s/%s/%s/%s/json" % (ARCHWEB_URL, repo, arch, name)
                 try:
-                    url_fd = urlopen(url_req, timeout=timeout)
-                    d = json.loads(url_fd.read().decode("utf-8", "ignore"))
+                    data = HttpClient().get(url, timeout, policy=policy).data
+                    d = json.loads(data.decode("utf-8", "ignore"))
                     v = d["pkgver"]
                     logging.debug("Archweb version is : %s" % v)
                     return v
@@ -286,18 +815,67 @@ class VersionController(object):
         raise VersionNotFound("No Archweb package found")
 
     @staticmethod
-    def get_version_downstream_aur(name, value):
-        '''Return archlinux user repository version'''
+    def index_downstream_aur(packages):
+        '''
+        Return archlinux user repository versions indexed by package name
+        Packages are requested by chunks with multiinfo RPC calls
+        Packages unknown by AUR are indexed with None version and those of
+        failed chunks are not indexed.
+        '''
+        index = {}
+        # retrieve config timeout and network policy
+        value = packages[0][1]
+        timeout = float(value["timeout"]) if "timeout" in value else None
+        policy = PackagesConfigFile.policy(value)
+        base = "%s?v=5&type=multiinfo" % AUR_RPC_URL
+        # split packages in chunks fitting the url length limit
+        chunks = [[]]
+        length = len(base)
+        for name, value in packages:
+            arglen = len("&arg[]=") + len(quote(name))
+            if length + arglen > AUR_RPC_MAX_LENGTH and len(chunks[-1]) > 0:
+                chunks.append([])
+                length = len(base)
+            chunks[-1].append(name)
+            length += arglen
+        for chunk in chunks:
+            url = base + "".join("&arg[]=%s" % quote(name) for name in chunk)
+            try:
+                data = HttpClient().get(url, timeout, policy=policy).data
+                d = json.loads(data.decode("utf-8", "ignore"))
+                if d.get("type") != "multiinfo":
+                    raise VersionNotFound("Unsupported AUR reply")
+                for result in d["results"]:
+                    index[result["Name"]] = result["Version"].rsplit("-")[0]
+            except Exception as exp:
+                logging.warning("AUR multiinfo failed: %s" % exp)
+                continue
+            for name in chunk:
+                index.setdefault(name, None)
+        logging.debug("AUR indexed %d packages in %d requests" % (len(index),
+                                                                  len(chunks)))
+        return index
+
+    @staticmethod
+    def get_version_downstream_aur(name, value, index=None):
+        '''
+        Return archlinux user repository version
+        Version is looked up in the multiinfo index and requested when
+        the package is not indexed
+        '''
         logging.debug("Get AUR version")
+        if index is not None and name in index:
+            if index[name] is None:
+                raise VersionNotFound("AUR check failed: No such package")
+            logging.debug("AUR version is : %s" % index[name])
+            return index[name]
         try:
-            # retrieve config timeout
+            # retrieve config timeout and network policy
             timeout = float(value["timeout"]) if "timeout" in value else None
-            url = "http://aur.archlinux.org/rpc.php?type=info&arg=%s" % name
-            url_req = Request(url, headers=HTTP_HEADERS)
-            logging.debug("Requesting url: %s" % url)
-            logging.debug("Timeout is %s" % timeout)
-            url_fd = urlopen(url_req, timeout=timeout)
-            d = json.loads(url_fd.read().decode("utf-8", "ignore"))
+            policy = PackagesConfigFile.policy(value)
+            url = "%s?type=info&arg=%s" % (AUR_RPC_URL, name)
+            data = HttpClient().get(url, timeout, policy=policy).data
+            d = json.loads(data.decode("utf-8", "ignore"))
             if "version" not in d or d["version"] != 1:
                 raise VersionNotFound("Unsupported AUR version")
             if len(d["results"]) == 0:
@@ -310,27 +888,41 @@ class VersionController(object):
         assert(False)
 
     @staticmethod
-    def get_version_downstream_abs(name, value):
-        '''Return abs version'''
+    def index_downstream_abs(packages):
+        '''
+        Return package names of ABS trees indexed by path and repository
+        Directory indexes are kept in cache between syncs
+        '''
+        cache = JsonDatabase()
+        cache.load(CACHE_ABS)
+        index = {}
+        for name, value in packages:
+            abspath = value.get("abs_path", "/var/abs")
+            if abspath not in index:
+                index[abspath] = abs_index(abspath, cache)
+        return index
+
+    @staticmethod
+    def get_version_downstream_abs(name, value, index=None):
+        '''
+        Return abs version
+        Package is looked up in the ABS index or in a new index of the
+        tree when there is no index
+        '''
         logging.debug("Get ABS version")
         # Get ABS tree path
         abspath = value.get("abs_path", "/var/abs")
-        # Map db and name
-        repos = [d for d in os.listdir(abspath)
-                 if os.path.isdir(os.path.join(abspath, d))]
+        repos = (index or {}).get(abspath)
+        if repos is None:
+            repos = abs_index(abspath)
         # filter if repo is provided
-        if "repo" in value:
-            allowed_repos = value.get("repo").split(",")
-            for r in list(repos):
-                if r not in allowed_repos:
-                    repos.remove(r)
+        allowed_repos = value.get("repo").split(",") if "repo" in value else None
         # looking into db for package name
-        for repo in repos:
-            logging.debug("Looking into directory %s" % repo)
-            repopath = os.path.join(abspath, repo)
-            packages = [d for d in os.listdir(repopath)]
-            if name in packages:
-                pkgpath = os.path.join(repopath, name, "PKGBUILD")
+        for repo in sorted(repos):
+            if allowed_repos is not None and repo not in allowed_repos:
+                continue
+            if name in repos[repo]:
+                pkgpath = os.path.join(abspath, repo, name, "PKGBUILD")
                 if os.path.isfile(pkgpath):
                     # use bash to export vars.
                     # WARNING: CODE IS EXECUTED
@@ -357,16 +949,61 @@ class VersionController(object):
         for mode in fnmatch.filter(dir(VersionController), "get_version_downstream_*"):
             print(mode[23:])
 
-    def print_versions(self, only_new=False, only_fresh=False):
-        '''Print versions'''
-        for name, v_upstream, v_downstream in self.compare(only_new, only_fresh):
-            self.print_version(name, v_upstream, v_downstream)
+    def print_versions(self, only_new=False, only_fresh=False, fmt="text",
+                       fileobj=None):
+        '''
+        Print versions in format fmt (text, tsv, jsonl or json)
+        Versions are written into fileobj (default stdout) as they are
+        compared.
+        '''
+        if fileobj is None:
+            fileobj = sys.stdout
+        fileobj.writelines(self.format_versions(self.compare(only_new, only_fresh),
+                                                fmt, fileobj.isatty()))
+
+    def format_versions(self, versions, fmt="text", color=False):
+        '''
+        Return an iterator over lines of versions in format fmt
+        versions is an iterable of name, upstream and downstream versions.
+        text lines are colored when color is True. tsv and jsonl lines hold
+        name, upstream and downstream versions and downstream mode. json is
+        a list of jsonl objects.
+        '''
+        if fmt not in ("text", "tsv", "jsonl", "json"):
+            raise ValueError("Invalid format: %s" % fmt)
+        if fmt == "json":
+            yield "["
+        first = True
+        for name, v_upstream, v_downstream in versions:
+            # aliases have the mode of their package
+            mode = self._packages.get(self.section(name), {}).get("downstream",
+                                                                  "downstream")
+            if fmt == "text":
+                yield "%s\n" % self.format_version(name, v_upstream, v_downstream,
+                                                   color)
+            elif fmt == "tsv":
+                yield "%s\t%s\t%s\t%s\n" % (name, v_upstream,
+                                             v_downstream or "", mode)
+            else:
+                line = json.dumps({"name": name, "upstream": v_upstream,
+                                   "downstream": v_downstream, "mode": mode})
+                if fmt == "jsonl":
+                    yield "%s\n" % line
+                else:
+                    yield "%s\n %s" % ("" if first else ",", line)
+            first = False
+        if fmt == "json":
+            yield "\n]\n"
 
     def print_version(self, name, v1, v2=None):
         '''Handle printing of 2 versions'''
+        print(self.format_version(name, v1, v2, sys.stdout.isatty()))
+
+    def format_version(self, name, v1, v2=None, color=False):
+        '''Return a text line of 2 versions, colored if color is True'''
         # define used color
         c_blue =  c_white =  c_yellow =  c_compare =  c_reset = ''
-        if sys.stdout.isatty():
+        if color:
             if v2 is None:   c_compare = '\033[1;33m'
             elif v1 == v2:   c_compare = '\033[1;32m'
             else:            c_compare = '\033[1;31m'
@@ -382,18 +1019,28 @@ class VersionController(object):
         if v2 != "":
             # print separator
             toprint += "%s|" % c_blue
-            origin = self._packages.get(name,{}).get("downstream", "downstream")
+            origin = self._packages.get(self.section(name), {}).get("downstream",
+                                                                    "downstream")
             toprint += " %s%s: %s" % (c_compare, origin, v2)
         toprint += c_reset
-        print(toprint)
+        return toprint
 
 
 class VersionKey(object):
-    '''Sorting key of a version string'''
+    '''
+    Sorting key of a version string
+    Versions are compared token by token. Numbers are compared as integers
+    and are greater than letters. A version prefix of another is lower.
+    '''
+
+    __slots__ = ("vstring", "key")
+
+    _tokens = re.compile("([0-9]+)|([a-zA-Z]+)")
 
     def __init__(self, vstring):
         self.vstring = vstring
-        self.vlist = re.findall("([0-9]+|[a-zA-Z]+)", vstring)
+        self.key = tuple([ (1, int(num)) if num else (0, word)
+                           for num, word in self._tokens.findall(vstring) ])
 
     def __repr__(self):
         return "%s ('%s')" % (self.__class__.__name__, self.vstring)
@@ -408,36 +1055,15 @@ class VersionKey(object):
         return self.vstring != other.vstring
 
     def __lt__(self, other):
-        try:
-            for i, a in enumerate(self.vlist):
-                b = other.vlist[i]
-                if a.isdigit() and b.isdigit():
-                    a = int(a)
-                    b = int(b)
-                    if a < b:
-                        return True
-                    elif a > b:
-                        return False
-                elif a.isdigit():
-                    return False
-                elif b.isdigit():
-                    return True
-                else:
-                    if a < b:
-                        return True
-                    elif a > b:
-                        return False
-        except IndexError:
-            return False
-        return True
+        return self.key < other.key
 
     def __gt__(self, other):
-        return not self.__lt__(other) and not self.__eq__(other)
+        return self.key > other.key
 
     def __le__(self, other):
-        return not self.__gt__(other)
+        return self.key <= other.key
 
     def __ge__(self, other):
-        return not self.__lt__(other)
+        return self.key >= other.key
 
 # vim:set ts=4 sw=4 et ai: